@@ -0,0 +1,42 @@
+"""
+Build the ball_kernels extension module ahead of time with numba.pycc.
+
+The exported kernel scans a whole contiguous frame, with the frame shape,
+threshold and sampling step baked in as constants. client.py uses it for
+full-frame scans when the extension has been built. The windowed scans, and
+every scan when the extension is missing, use the JIT kernel in client.py.
+
+numba.pycc is pending deprecation in current numba releases. Building the
+extension is optional, since the JIT kernel computes the same result.
+"""
+from numba.pycc import CC
+from frame_constants import FRAME_HEIGHT, FRAME_WIDTH, BALL_THRESHOLD, DOWNSCALE
+
+cc = CC('ball_kernels')
+
+@cc.export('centroid_400x800', 'UniTuple(f8, 2)(u1[:, :, ::1])')
+def centroid_400x800(frame):
+    """
+    Compute the centroid of the white pixels of a contiguous 400x800 BGR frame.
+
+    Args:
+        frame (ndarray): The BGR frame to scan.
+
+    Returns:
+        tuple: The centroid in frame coordinates, or (-1, -1) if no pixel matches.
+    """
+    sum_x = 0
+    sum_y = 0
+    count = 0
+    for y in range(0, FRAME_HEIGHT, DOWNSCALE):
+        for x in range(0, FRAME_WIDTH, DOWNSCALE):
+            if frame[y, x, 0] >= BALL_THRESHOLD:
+                sum_x += x
+                sum_y += y
+                count += 1
+    if count == 0:
+        return -1.0, -1.0
+    return sum_x / count, sum_y / count
+
+if __name__ == '__main__':
+    cc.compile()
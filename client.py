@@ -1,10 +1,116 @@
 import argparse
 import asyncio
+import functools
+import queue
+import struct
+import threading
 import cv2
 import numpy as np
 import multiprocessing as mp
+from multiprocessing import shared_memory
+from numba import njit, prange
 from aiortc import RTCIceCandidate, RTCPeerConnection, RTCSessionDescription
 from aiortc.contrib.signaling import create_signaling
+from frame_constants import FRAME_HEIGHT, FRAME_WIDTH, DOWNSCALE, BALL_THRESHOLD
+
+try:
+    # Full-frame kernel specialized for the frame shape, built by build_kernels.py
+    from ball_kernels import centroid_400x800
+except ImportError:
+    centroid_400x800 = None
+
+# Radius of the ball drawn by the server
+BALL_RADIUS = 30
+# Half size of the area searched around the previous ball center. The ball moves
+# 20 px per frame, and a few frames may pass between two recognized ones
+SEARCH_MARGIN = BALL_RADIUS + 3 * 20
+# Capacity of the queue between the receiving and conversion stages
+PIPELINE_QUEUE_SIZE = 2
+# Binary position message sent to the server: x, y and the frame timestamp
+POSITION_STRUCT = struct.Struct('<ddI')
+
+class SharedFrameBuffer:
+    """
+    A single frame slot in shared memory that always holds the latest frame.
+
+    The writer moves the sequence number to an odd value before copying a frame in
+    and back to an even value afterwards, so a reader can tell that the frame it
+    processed in place was overwritten in the meantime.
+    """
+    def __init__(self, shape):
+        """
+        Allocate the shared memory for one frame.
+
+        Args:
+            shape (tuple): The shape of the uint8 frames to hold.
+        """
+        self.shape = shape
+        self.shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)))
+        self.seq = mp.Value('i', 0)
+        self.pts = mp.Value('I', 0)
+        self.ready = mp.Event()
+        self.frame = np.ndarray(shape, dtype=np.uint8, buffer=self.shm.buf)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # The array is rebuilt over the shared memory instead of being pickled
+        del state['frame']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.frame = np.ndarray(self.shape, dtype=np.uint8, buffer=self.shm.buf)
+
+    def publish(self, frame, pts):
+        """
+        Copy a frame into the slot, replacing the previous one.
+
+        Args:
+            frame (ndarray): The frame to publish.
+            pts (int): The presentation timestamp of the frame.
+        """
+        self.seq.value += 1
+        np.copyto(self.frame, frame)
+        self.pts.value = pts
+        self.seq.value += 1
+        self.ready.set()
+
+    def wait(self, last_seq):
+        """
+        Block until a frame newer than the one last processed is complete.
+
+        Args:
+            last_seq (int): The sequence number of the last processed frame.
+
+        Returns:
+            tuple: The sequence number and the timestamp of the new frame.
+        """
+        while True:
+            self.ready.wait()
+            self.ready.clear()
+            seq = self.seq.value
+            if seq != last_seq and seq % 2 == 0:
+                return seq, self.pts.value
+
+    def is_current(self, seq):
+        """
+        Check that the frame with the given sequence number has not been overwritten.
+
+        Args:
+            seq (int): The sequence number returned by wait.
+
+        Returns:
+            bool: True if the slot still holds that frame.
+        """
+        return self.seq.value == seq
+
+    def close(self):
+        """
+        Release and remove the shared memory.
+        """
+        self.frame = None
+        self.shm.close()
+        self.shm.unlink()
 
 class FrameDisplay:
     """
@@ -20,93 +126,265 @@ class FrameDisplay:
         """
         self.name = name
         self.track = track
-    
-    async def show(self, frame_queue):
+        # Single slot holding the latest frame for the display thread
+        self.latest_frame = queue.Queue(maxsize=1)
+        self.stop_event = threading.Event()
+        self.display_thread = threading.Thread(target=self._display_loop, daemon=True)
+        self.display_thread.start()
+
+    def _display_loop(self):
         """
-        Display the frames using OpenCV.
+        Show the latest frame until stopped or 'q' is pressed, running on the display thread.
+        """
+        while not self.stop_event.is_set():
+            try:
+                ball_frame = self.latest_frame.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            cv2.imshow(self.name, ball_frame)
+            key = cv2.waitKey(1)
+            if key == ord('q'):
+                self.stop_event.set()
+        cv2.destroyAllWindows()
+
+    def _offer(self, ball_frame):
+        """
+        Hand a frame to the display thread, dropping a frame it has not shown yet.
+
+        Every frame is a new array that is never written again after this call, so
+        the display thread can read it without racing the conversion stage.
 
         Args:
-            frame_queue (Queue): The queue to put frames for display.
+            ball_frame (ndarray): The frame to display.
         """
-        if self.track is None:
-            return
+        try:
+            self.latest_frame.get_nowait()
+        except queue.Empty:
+            pass
+        self.latest_frame.put_nowait(ball_frame)
 
+    async def _receive(self, raw_frames):
+        """
+        Pipeline stage receiving the frames from the track.
+
+        Args:
+            raw_frames (asyncio.Queue): The queue to put received frames, None marks the end of the track.
+        """
         while True:
             frame = None
             try:
                 frame = await self.track.recv()
             except Exception:
-                break
+                pass
+            await raw_frames.put(frame)
             if frame is None:
                 break
 
-            ball_frame = frame.to_ndarray(format="bgr24")
-            timestamp = frame.pts
-            frame_queue.put((ball_frame, timestamp))
-            cv2.imshow(self.name, ball_frame)
-            key = cv2.waitKey(1) 
-            if key == ord('q'):
+    async def _convert(self, raw_frames, frame_buffer):
+        """
+        Pipeline stage converting the frames to BGR arrays, publishing them for
+        recognition and handing them to the display thread.
+
+        Args:
+            raw_frames (asyncio.Queue): The queue to get received frames.
+            frame_buffer (SharedFrameBuffer): The buffer to publish frames for recognition.
+        """
+        loop = asyncio.get_running_loop()
+        while not self.stop_event.is_set():
+            frame = await raw_frames.get()
+            if frame is None:
                 break
 
-        cv2.destroyAllWindows()
+            ball_frame = await loop.run_in_executor(None, functools.partial(frame.to_ndarray, format="bgr24"))
+            frame_buffer.publish(ball_frame, frame.pts)
+            self._offer(ball_frame)
+
+    async def show(self, frame_buffer):
+        """
+        Display the frames using OpenCV.
+
+        Receiving and conversion run as separate tasks connected by a bounded
+        queue, while the window is driven by a dedicated display thread.
+
+        Args:
+            frame_buffer (SharedFrameBuffer): The buffer to publish frames for recognition.
+        """
+        if self.track is None:
+            self.stop_event.set()
+            return
+
+        raw_frames = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        receiver = asyncio.create_task(self._receive(raw_frames))
+        try:
+            await self._convert(raw_frames, frame_buffer)
+        finally:
+            receiver.cancel()
+            self.stop_event.set()
+            await asyncio.get_running_loop().run_in_executor(None, self.display_thread.join)
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _centroid_bgr(frame, thr, step, y0, y1, x0, x1):
+    """
+    Compute the centroid of the pixels whose blue channel reaches a threshold.
+
+    Only every step-th row and column of the window [y0, y1) x [x0, x1) is
+    sampled, and no intermediate mask is built.
+
+    Args:
+        frame (ndarray): The BGR frame to scan.
+        thr (int): The minimum value of the blue channel.
+        step (int): The sampling step in both directions.
+        y0 (int): The first row of the window.
+        y1 (int): The row past the end of the window.
+        x0 (int): The first column of the window.
+        x1 (int): The column past the end of the window.
+
+    Returns:
+        tuple: The centroid in frame coordinates, or (-1, -1) if no pixel matches.
+    """
+    sum_x = 0
+    sum_y = 0
+    count = 0
+    for i in prange((y1 - y0 + step - 1) // step):
+        y = y0 + i * step
+        for x in range(x0, x1, step):
+            if frame[y, x, 0] >= thr:
+                sum_x += x
+                sum_y += y
+                count += 1
+    if count == 0:
+        return -1.0, -1.0
+    return sum_x / count, sum_y / count
+
+def _scan(frame, y0, y1, x0, x1):
+    """
+    Compute the ball centroid within a window with the best available kernel.
+
+    Full-frame scans use the ahead-of-time kernel when it has been built, and
+    windowed scans always use the parallel JIT kernel.
+
+    Args:
+        frame (ndarray): The frame to process.
+        y0 (int): The first row of the window.
+        y1 (int): The row past the end of the window.
+        x0 (int): The first column of the window.
+        x1 (int): The column past the end of the window.
+
+    Returns:
+        tuple: The centroid in frame coordinates, or (-1, -1) if no ball pixel is found.
+    """
+    full_frame = (y0, y1, x0, x1) == (0, FRAME_HEIGHT, 0, FRAME_WIDTH)
+    if centroid_400x800 is not None and full_frame and frame.shape == (FRAME_HEIGHT, FRAME_WIDTH, 3):
+        return centroid_400x800(frame)
+    return _centroid_bgr(frame, BALL_THRESHOLD, DOWNSCALE, y0, y1, x0, x1)
 
-def get_ball_contours(frame):
+def get_ball_contours(frame, last_pos=None):
     """
-    Recognize the position of the ball using cv2.findContours.
+    Recognize the position of the ball as the centroid of its white pixels.
+
+    When the previous center is known only the area around it is scanned, and the
+    whole frame is scanned if the ball is not entirely inside that area.
 
     Args:
         frame (ndarray): The frame to process.
+        last_pos (tuple): The previous coordinates of the ball center, if known.
 
     Returns:
-        tuple: The coordinates of the ball center.
-    """
-    lower_bound = np.array([0, 0, 200])
-    upper_bound = np.array([180, 55, 255])
-    hsv_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
-    mask = cv2.inRange(hsv_frame, lower_bound, upper_bound)
-    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    if not contours:
+        tuple: The coordinates of the ball center, or None if no ball is found.
+    """
+    height, width = frame.shape[:2]
+    if last_pos is not None:
+        # Align the window to the sampling grid of the full-frame scan
+        y0 = max(int(last_pos[1]) - SEARCH_MARGIN, 0) // DOWNSCALE * DOWNSCALE
+        x0 = max(int(last_pos[0]) - SEARCH_MARGIN, 0) // DOWNSCALE * DOWNSCALE
+        y1 = min(int(last_pos[1]) + SEARCH_MARGIN, height)
+        x1 = min(int(last_pos[0]) + SEARCH_MARGIN, width)
+        center = _scan(frame, y0, y1, x0, x1)
+        cx, cy = center
+        if (cx >= 0
+                and (x0 == 0 or cx - BALL_RADIUS > x0) and (x1 == width or cx + BALL_RADIUS < x1)
+                and (y0 == 0 or cy - BALL_RADIUS > y0) and (y1 == height or cy + BALL_RADIUS < y1)):
+            return center
+
+    center = _scan(frame, 0, height, 0, width)
+    if center[0] < 0:
         return None
-    max_contour = max(contours, key=cv2.contourArea)
-    contours_poly = cv2.approxPolyDP(max_contour, 3, True)
-    center, _ = cv2.minEnclosingCircle(contours_poly)
     return center
 
-async def track_ball_position(frame_queue, pos_x, pos_y, timestamp):
+def read_position(pos_x, pos_y, timestamp):
+    """
+    Read the ball position and its timestamp as one consistent snapshot.
+
+    Args:
+        pos_x (Value): The shared value for the X position of the ball.
+        pos_y (Value): The shared value for the Y position of the ball.
+        timestamp (Value): The shared value for the timestamp.
+
+    Returns:
+        tuple: The X position, the Y position and the timestamp.
+    """
+    # The values share one lock, so take it once and read the raw values
+    with pos_x.get_lock():
+        return pos_x.get_obj().value, pos_y.get_obj().value, timestamp.get_obj().value
+
+def write_position(pos_x, pos_y, timestamp, position):
+    """
+    Write the ball position and its timestamp as one consistent snapshot.
+
+    Args:
+        pos_x (Value): The shared value for the X position of the ball.
+        pos_y (Value): The shared value for the Y position of the ball.
+        timestamp (Value): The shared value for the timestamp.
+        position (tuple): The X position, the Y position and the timestamp.
+    """
+    with pos_x.get_lock():
+        pos_x.get_obj().value, pos_y.get_obj().value, timestamp.get_obj().value = position
+
+def track_ball_position(frame_buffer, pos_x, pos_y, timestamp, position_updated):
     """
-    Coroutine to track the position of the ball and update shared values.
+    Track the position of the ball and update shared values.
+
+    The buffer only holds the latest frame, so when recognition falls behind the
+    frames published in the meantime are skipped rather than queued.
 
     Args:
-        frame_queue (Queue): The queue to get frames for processing.
+        frame_buffer (SharedFrameBuffer): The buffer to get frames for processing.
         pos_x (Value): The shared value for the X position of the ball.
         pos_y (Value): The shared value for the Y position of the ball.
         timestamp (Value): The shared value for the timestamp.
+        position_updated (Event): The event set whenever the shared values are updated.
     """
+    seq = 0
+    last_pos = None
     while True:
-        frame, pts = frame_queue.get(True)
-        pos = get_ball_contours(frame)
+        seq, pts = frame_buffer.wait(seq)
+        pos = get_ball_contours(frame_buffer.frame, last_pos)
+        # Discard the result if the frame was replaced while it was being scanned
+        if not frame_buffer.is_current(seq):
+            continue
+        last_pos = pos
         if pos:
-            pos_x.value = pos[0]
-            pos_y.value = pos[1]
-            timestamp.value = pts
+            write_position(pos_x, pos_y, timestamp, (pos[0], pos[1], pts))
+            position_updated.set()
 
-def run_recognition_task(frame_queue, pos_x, pos_y, timestamp):
+def run_recognition_task(frame_buffer, pos_x, pos_y, timestamp, position_updated):
     """
     Main function to start the recognition task.
 
     Args:
-        frame_queue (Queue): The queue to get frames for processing.
+        frame_buffer (SharedFrameBuffer): The buffer to get frames for processing.
         pos_x (Value): The shared value for the X position of the ball.
         pos_y (Value): The shared value for the Y position of the ball.
         timestamp (Value): The shared value for the timestamp.
+        position_updated (Event): The event set whenever the shared values are updated.
     """
-    loop = asyncio.get_event_loop()
+    # Compile the centroid kernel before the first frame arrives
+    _centroid_bgr(np.zeros((FRAME_HEIGHT, FRAME_WIDTH, 3), dtype=np.uint8), BALL_THRESHOLD, DOWNSCALE,
+                  0, FRAME_HEIGHT, 0, FRAME_WIDTH)
     try:
-        loop.run_until_complete(track_ball_position(frame_queue, pos_x, pos_y, timestamp))
+        track_ball_position(frame_buffer, pos_x, pos_y, timestamp, position_updated)
     except KeyboardInterrupt:
         pass
-    finally:
-        loop.close()
 
 async def handle_signaling(peer_connection, signaling):
     """
@@ -128,7 +406,7 @@ async def handle_signaling(peer_connection, signaling):
         else:
             break
 
-async def send_position_on_change(channel, pos_x, pos_y, timestamp):
+async def send_position_on_change(channel, pos_x, pos_y, timestamp, position_updated):
     """
     Send the ball position when it changes.
 
@@ -137,40 +415,42 @@ async def send_position_on_change(channel, pos_x, pos_y, timestamp):
         pos_x (Value): The shared value for the X position of the ball.
         pos_y (Value): The shared value for the Y position of the ball.
         timestamp (Value): The shared value for the timestamp.
+        position_updated (Event): The event set whenever the shared values are updated.
     """
-    prev_pos_x = pos_x.value
-    prev_pos_y = pos_y.value
-    prev_timestamp = timestamp.value
+    loop = asyncio.get_running_loop()
+    prev_position = read_position(pos_x, pos_y, timestamp)
 
     while True:
-        if pos_x.value != prev_pos_x or pos_y.value != prev_pos_y or timestamp.value != prev_timestamp:
-            msg = f'Location {round(pos_x.value, 2)} {round(pos_y.value, 2)} Timestamp {timestamp.value}'
-            channel.send(msg)
-            prev_pos_x = pos_x.value
-            prev_pos_y = pos_y.value
-            prev_timestamp = timestamp.value
-        await asyncio.sleep(0.1)
+        # Wait with a timeout so the executor thread never blocks shutdown
+        if not await loop.run_in_executor(None, position_updated.wait, 0.5):
+            continue
+        position_updated.clear()
+        position = read_position(pos_x, pos_y, timestamp)
+        if position != prev_position:
+            channel.send(POSITION_STRUCT.pack(*position))
+            prev_position = position
 
-async def handle_answer(peer_connection, signaling, frame_queue, pos_x, pos_y, timestamp):
+async def handle_answer(peer_connection, signaling, frame_buffer, pos_x, pos_y, timestamp, position_updated):
     """
     Handle the answer from the server and respond.
 
     Args:
         peer_connection (RTCPeerConnection): The peer connection.
         signaling (Signaling): The signaling method.
-        frame_queue (Queue): The queue to transfer the ball track.
+        frame_buffer (SharedFrameBuffer): The buffer to transfer the ball track.
         pos_x (Value): The shared value for the X position of the ball.
         pos_y (Value): The shared value for the Y position of the ball.
         timestamp (Value): The shared value for the timestamp.
+        position_updated (Event): The event set whenever the shared values are updated.
     """
     @peer_connection.on('track')
     async def on_track(track):
         display = FrameDisplay('Ball Tracking', track)
-        await display.show(frame_queue)
+        await display.show(frame_buffer)
 
     @peer_connection.on('datachannel')
     def on_datachannel(channel):
-        asyncio.create_task(send_position_on_change(channel, pos_x, pos_y, timestamp))
+        asyncio.create_task(send_position_on_change(channel, pos_x, pos_y, timestamp, position_updated))
 
         @channel.on('message')
         def on_message(message):
@@ -186,20 +466,29 @@ if __name__ == '__main__':
     parser.add_argument('--signaling_port', type=str, default='8080', help='Signaling port, default is 8080.')
     
     args = parser.parse_args()
+
+    # Use the libuv based event loop when it is available
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
     
     mp.set_start_method('spawn')
-    frame_queue = mp.Queue(100)
-    pos_x = mp.Value('d', 0.0)
-    pos_y = mp.Value('d', 0.0)
-    timestamp = mp.Value('i', 0)
+    frame_buffer = SharedFrameBuffer((FRAME_HEIGHT, FRAME_WIDTH, 3))
+    position_lock = mp.RLock()
+    pos_x = mp.Value('d', 0.0, lock=position_lock)
+    pos_y = mp.Value('d', 0.0, lock=position_lock)
+    timestamp = mp.Value('I', 0, lock=position_lock)
+    position_updated = mp.Event()
     
-    recognition_process = mp.Process(target=run_recognition_task, args=(frame_queue, pos_x, pos_y, timestamp))
+    recognition_process = mp.Process(target=run_recognition_task, args=(frame_buffer, pos_x, pos_y, timestamp, position_updated))
     recognition_process.start()
     
     signaling = create_signaling(args)
     peer_connection = RTCPeerConnection()
     
-    server_task = handle_answer(peer_connection, signaling, frame_queue, pos_x, pos_y, timestamp)
+    server_task = handle_answer(peer_connection, signaling, frame_buffer, pos_x, pos_y, timestamp, position_updated)
     main = asyncio.gather(server_task)
     
     event_loop = asyncio.get_event_loop()
@@ -212,3 +501,4 @@ if __name__ == '__main__':
         event_loop.run_until_complete(peer_connection.close())
         event_loop.run_until_complete(signaling.close())
         event_loop.close()
+        frame_buffer.close()
@@ -0,0 +1,10 @@
+"""
+Frame and recognition constants shared by client.py and build_kernels.py.
+"""
+# Dimensions of the frames streamed by the server
+FRAME_HEIGHT, FRAME_WIDTH = 400, 800
+# Decimation factor applied to the frame before locating the ball
+DOWNSCALE = 4
+# Minimum blue value for a pixel to belong to the ball. The ball is white on a
+# black background, so one channel is enough to tell them apart
+BALL_THRESHOLD = 200
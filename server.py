@@ -3,10 +3,19 @@ import cv2
 from av import VideoFrame
 from aiortc import VideoStreamTrack, RTCPeerConnection, RTCSessionDescription, RTCIceCandidate
 from aiortc.contrib.signaling import create_signaling
+from aiortc.mediastreams import VIDEO_CLOCK_RATE, VIDEO_PTIME
 import math
+import struct
 import asyncio
 import argparse
 
+# Number of recent frames whose ball position is remembered
+POSITION_HISTORY_SIZE = 1024
+# Increment of the presentation timestamp between two consecutive frames
+FRAME_PTS_STEP = int(VIDEO_CLOCK_RATE * VIDEO_PTIME)
+# Binary position message sent by the client: x, y and the frame timestamp
+POSITION_STRUCT = struct.Struct('<ddI')
+
 class BouncingBallVideoStreamTrack(VideoStreamTrack):
     """
     A video track that returns a frame with a bouncing ball.
@@ -35,7 +44,17 @@ class BouncingBallVideoStreamTrack(VideoStreamTrack):
         # Move speed and direction
         self.speed = 20
         self.angle = np.random.uniform(0, 2 * np.pi)  # Random initial angle in radians
-        self.position_history = {}
+        # Per-frame displacement, only its sign changes on bounces
+        self.vx = int(self.speed * math.cos(self.angle))
+        self.vy = int(self.speed * math.sin(self.angle))
+        # Ring buffer of (pts, x, y) rows for the most recent frames
+        self.position_history = np.full((POSITION_HISTORY_SIZE, 3), -1, dtype=np.int64)
+
+        # Blank canvas reused for every frame and the ball rasterized once
+        self.canvas = np.zeros((self.height, self.width, 3), dtype='uint8')
+        self.sprite = np.zeros((2 * self.radius + 1, 2 * self.radius + 1, 3), dtype='uint8')
+        cv2.circle(self.sprite, (self.radius, self.radius), self.radius, self.color, -1)
+        self.prev_roi = (slice(0, 0), slice(0, 0))
 
     async def recv(self):
         """
@@ -48,25 +67,46 @@ class BouncingBallVideoStreamTrack(VideoStreamTrack):
         pts, time_base = await self.next_timestamp()
 
         # Update position
-        self.x += int(self.speed * math.cos(self.angle))
-        self.y += int(self.speed * math.sin(self.angle))
+        self.x += self.vx
+        self.y += self.vy
 
-        # Check for collisions and update angle
+        # Check for collisions and reflect the direction
         if self.y >= self.height - self.radius or self.y <= self.radius:
-            self.angle = -self.angle
+            self.vy = -self.vy
         if self.x >= self.width - self.radius or self.x <= self.radius:
-            self.angle = np.pi - self.angle
-
-        # Create frame
-        ball_frame = np.zeros((self.height, self.width, 3), dtype='uint8')
-        cv2.circle(ball_frame, (self.x, self.y), self.radius, self.color, -1)
-        frame = VideoFrame.from_ndarray(ball_frame, format="bgr24")
+            self.vx = -self.vx
+
+        # Create frame by erasing the previous ball and blitting the sprite,
+        # clipped since the ball may overshoot a wall before it bounces back
+        self.canvas[self.prev_roi] = 0
+        top, left = self.y - self.radius, self.x - self.radius
+        y0, y1 = max(top, 0), min(top + self.sprite.shape[0], self.height)
+        x0, x1 = max(left, 0), min(left + self.sprite.shape[1], self.width)
+        roi = (slice(y0, y1), slice(x0, x1))
+        self.canvas[roi] = self.sprite[y0 - top:y1 - top, x0 - left:x1 - left]
+        self.prev_roi = roi
+        frame = VideoFrame.from_ndarray(self.canvas, format="bgr24")
         frame.pts = pts
         frame.time_base = time_base
-        self.position_history[pts] = (self.x, self.y)
+        self.position_history[(pts // FRAME_PTS_STEP) % POSITION_HISTORY_SIZE] = (pts, self.x, self.y)
 
         return frame
 
+    def get_position(self, pts):
+        """
+        Look up the position of the ball in a recent frame.
+
+        Parameters:
+        pts (int): The presentation timestamp of the frame.
+
+        Returns:
+        tuple: The ball coordinates, or (None, None) if the frame is no longer remembered.
+        """
+        stored_pts, x, y = self.position_history[(pts // FRAME_PTS_STEP) % POSITION_HISTORY_SIZE]
+        if stored_pts != pts:
+            return None, None
+        return int(x), int(y)
+
 
 async def handle_signaling_messages(peer_connection, signaling):
     """
@@ -99,15 +139,16 @@ async def server_side_handler(peer_connection, signaling):
 
     @data_channel.on('message')
     def on_message(message):
-        if isinstance(message, str) and message.startswith('Location'):
-            message_values = message.strip().split(' ')
-            predicted_x = float(message_values[1])
-            predicted_y = float(message_values[2])
-            timestamp = int(message_values[4])
-            real_x, real_y = ball_track.position_history.get(timestamp, (None, None))
-            position_error = (round(abs(predicted_x - real_x), 2), round(abs(predicted_y - real_y), 2))
-            print(f'Determined Location: ({predicted_x}, {predicted_y}), Real Location: ({real_x}, {real_y}), Error: ({position_error[0]}, {position_error[1]})')
-            response_message = f'result {message_values[4]} displayed'
+        if isinstance(message, (bytes, bytearray)) and len(message) == POSITION_STRUCT.size:
+            predicted_x, predicted_y, timestamp = POSITION_STRUCT.unpack(message)
+            predicted_x, predicted_y = round(predicted_x, 2), round(predicted_y, 2)
+            real_x, real_y = ball_track.get_position(timestamp)
+            if real_x is None:
+                print(f'Determined Location: ({predicted_x}, {predicted_y}), Real Location: unknown, no frame recorded for timestamp {timestamp}')
+            else:
+                position_error = (round(abs(predicted_x - real_x), 2), round(abs(predicted_y - real_y), 2))
+                print(f'Determined Location: ({predicted_x}, {predicted_y}), Real Location: ({real_x}, {real_y}), Error: ({position_error[0]}, {position_error[1]})')
+            response_message = f'result {timestamp} displayed'
             data_channel.send(response_message)
 
     # Send media track
@@ -127,6 +168,13 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
 
+    # Use the libuv based event loop when it is available
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+
     # Create TCP socket signaling
     signaling_instance = create_signaling(args)
     # Create peer connection